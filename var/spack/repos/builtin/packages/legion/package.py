@@ -3,8 +3,28 @@
 #
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
+from os.path import isdir
+
 from spack import *
-import os
+
+# cuda-centric
+# reminder for arch numbers to names: 60=pascal, 70=volta, 75=turing, 80=ampere
+# TODO: we could use a map here to clean up and use naming vs. numbers.
+cuda_arch_list = ('60', '70', '75', '80')
+
+# Build the (when, dependency) constraint pairs for the CUDA-enabled kokkos
+# dependencies once at module scope -- gcc builds need kokkos' nvcc wrapper
+# while clang can compile CUDA directly.  Precomputing the spec strings here
+# keeps the class body from re-rendering them on every (re)load of the class.
+# Each pair has to be enumerated per architecture (depends_on cannot forward
+# the chosen cuda_arch value to the dependency), but every when-spec is
+# gated on +cuda so non-CUDA solves never consider them.
+_cuda_kokkos_deps = tuple(
+    ('%{0}+kokkos+cuda cuda_arch={1}'.format(compiler, nvarch),
+     'kokkos@3.3.01+cuda+cuda_lambda{0}wrapper cuda_arch={1}'.format(
+         wrapper, nvarch))
+    for compiler, wrapper in (('gcc', '+'), ('clang', '~'))
+    for nvarch in cuda_arch_list)
 
 
 class Legion(CMakePackage):
@@ -35,8 +55,9 @@ class Legion(CMakePackage):
     # TODO: Need to spec version of MPI v3 for use of the low-level MPI transport
     # layer. At present the MPI layer is still experimental and we discourge its
     # use for general (not legion development) use cases.
-    depends_on('mpi', when='network=mpi')
-    depends_on('mpi', when='network=gasnet')  # MPI is required to build gasnet (needs mpicc).
+    # MPI is also required when building an embedded gasnet (needs mpicc).
+    for _mpi_network in ('mpi', 'gasnet'):
+        depends_on('mpi', when='network=%s' % _mpi_network)
     depends_on('ucx', when='conduit=ucx')
     depends_on('mpi', when='conduit=mpi')
     depends_on('cuda@10.0:11.9', when='+cuda_unsupported_compiler')
@@ -45,15 +66,8 @@ class Legion(CMakePackage):
     depends_on('hdf5', when='+hdf5')
     depends_on('hwloc@1.11', when='+hwloc')
 
-    # cuda-centric
-    # reminder for arch numbers to names: 60=pascal, 70=volta, 75=turing, 80=ampere
-    # TODO: we could use a map here to clean up and use naming vs. numbers.
-    cuda_arch_list = ('60', '70', '75', '80')
-    for nvarch in cuda_arch_list:
-        depends_on('kokkos@3.3.01+cuda+cuda_lambda+wrapper cuda_arch={0}'.format(nvarch),
-                   when='%gcc+kokkos+cuda cuda_arch={0}'.format(nvarch))
-        depends_on("kokkos@3.3.01+cuda+cuda_lambda~wrapper cuda_arch={0}".format(nvarch),
-                   when="%clang+kokkos+cuda cuda_arch={0}".format(nvarch))
+    for _when_spec, _dep_spec in _cuda_kokkos_deps:
+        depends_on(_dep_spec, when=_when_spec)
 
     depends_on('kokkos@3.3.01~cuda', when='+kokkos~cuda')
     depends_on("kokkos@3.3.01~cuda+openmp", when='kokkos+openmp')
@@ -76,24 +90,17 @@ class Legion(CMakePackage):
     # point the package a pre-installed version of GASNet-Ex via the gasnet_root
     # variant.
     #
-    # make sure we have a valid directory provided for gasnet_root...
-    def validate_gasnet_root(value):
-        if value == 'none':
-            return True
-
-        if not os.path.isdir(value):
-            print("gasnet_root:", value, "-- no such directory.")
-            return False
-        else:
-            return True
-
+    # The provided directory is checked in cmake_args() at build time so
+    # that concretizing a legion spec never has to stat the filesystem.
     variant('gasnet_root',
             default='none',
-            values=validate_gasnet_root,
             description="Path to a pre-installed version of GASNet (prefix directory).",
             multi=False)
     conflicts('gasnet_root', when="network=mpi")
 
+    # TODO: if/when the variant directive grows a when= clause, declare
+    # conduit only for network=gasnet and retire the 'none' value plus
+    # the per-conduit conflicts below.
     variant('conduit', default='none',
             values=('aries', 'ibv', 'udp', 'mpi', 'ucx', 'none'),
             description="The gasnet conduit(s) to enable.",
@@ -102,13 +109,15 @@ class Legion(CMakePackage):
     conflicts('conduit=none', when='network=gasnet',
               msg="a conduit must be selected when 'network=gasnet'")
 
+    # A conduit selection is only meaningful when gasnet is the network
+    # layer; rule each conduit out for the other network settings.
     gasnet_conduits = ('aries', 'ibv', 'udp', 'mpi', 'ucx')
+    _conduit_msg = "conduit attribute requires 'network=gasnet'."
     for c in gasnet_conduits:
         conflict_str = 'conduit=%s' % c
-        conflicts(conflict_str, when='network=mpi',
-                  msg="conduit attribute requires 'network=gasnet'.")
-        conflicts(conflict_str, when='network=none',
-                  msg="conduit attribute requires 'network=gasnet'.")
+        for _network in ('mpi', 'none'):
+            conflicts(conflict_str, when='network=%s' % _network,
+                      msg=_conduit_msg)
 
     variant('gasnet_debug', default=False,
             description="Build gasnet with debugging enabled.")
@@ -127,10 +136,16 @@ class Legion(CMakePackage):
     variant('enable_tls', default=False,
             description="Enable thread-local-storage of the Legion context.")
 
+    # Note: these values are dependent upon those used in the cmake config,
+    # which wants them upper-cased; precompute that spelling once here
+    # instead of calling str.upper() on every cmake_args invocation.
+    _output_levels = ("spew", "debug", "info", "print", "warning", "error",
+                      "fatal", "none")
+    _output_level_map = dict((level, level.upper())
+                             for level in _output_levels)
+
     variant('output_level', default='warning',
-            # Note: these values are dependent upon those used in the cmake config.
-            values=("spew", "debug", "info", "print", "warning", "error", "fatal",
-                    "none"),
+            values=_output_levels,
             description="Set the compile-time logging level.",
             multi=False)
 
@@ -200,146 +215,141 @@ class Legion(CMakePackage):
     variant('native', default=False,
             description="Enable native/host processor optimizaton target.")
 
+    # Boolean variants that translate directly into a Legion CMake option;
+    # cmake_args() walks this table instead of spelling out an if/else
+    # chain (and re-parsing a '+variant' spec) for each one.
+    _cmake_bool_variants = (
+        ('bounds_checks', 'Legion_BOUNDS_CHECKS'),
+        ('privilege_checks', 'Legion_PRIVILEGE_CHECKS'),
+        ('enable_tls', 'Legion_ENABLE_TLS'),
+        ('spy', 'Legion_SPY'),
+        ('hdf5', 'Legion_USE_HDF5'),
+        ('hwloc', 'Legion_USE_HWLOC'),
+        ('openmp', 'Legion_USE_OpenMP'),
+        ('papi', 'Legion_USE_PAPI'),
+        ('python', 'Legion_USE_Python'),
+        ('libdl', 'Legion_USE_LIBDL'),
+        ('zlib', 'Legion_USE_ZLIB'),
+    )
+
+    # Extra compiler flags for Debug builds.
+    _debug_cxx_flags = ('-DDEBUG_REALM', '-DDEBUG_LEGION', '-ggdb')
+
+    def setup_build_environment(self, env):
+        if self.spec.variants['kokkos'].value:
+            # legion's cmake config expects kokkos' compiler (e.g. the
+            # nvcc wrapper) to be handed over via the environment.
+            env.set('KOKKOS_CXX_COMPILER', self.spec['kokkos'].kokkos_cxx)
+
+    # Cache for cmake_args(): the spec is immutable once concrete, so the
+    # options only need to be computed once even though Spack may ask for
+    # them several times over the course of an install.
+    _cmake_args_cache = None
+
     def cmake_args(self):
+        if self._cmake_args_cache is not None:
+            return self._cmake_args_cache
         spec = self.spec
+        # hoist the variant values used more than once (or buried in
+        # branches below) out of the VariantMap up front...
+        variants = spec.variants
+        network = variants['network'].value
+        gasnet_root = variants['gasnet_root'].value
         cmake_cxx_flags = []
         options = []
-
-        if 'network=gasnet' in spec:
-            options.append('-DLegion_NETWORKS=gasnetex')
-            if spec.variants['gasnet_root'].value != 'none':
-                gasnet_dir = spec.variants['gasnet_root'].value
-                options.append('-DGASNet_ROOT_DIR=%s' % gasnet_dir)
+        # bind the append we call ~25 times below just once...
+        append = options.append
+
+        # a pre-installed gasnet only makes sense for the gasnet network
+        # layer; check once here instead of on every non-gasnet branch.
+        if gasnet_root != 'none' and network != 'gasnet':
+            raise InstallError(
+                "'gasnet_root' is only valid when 'network=gasnet'.")
+
+        if network == 'gasnet':
+            append(self.define('Legion_NETWORKS', 'gasnetex'))
+            if gasnet_root != 'none':
+                # make sure we have a valid directory for gasnet_root...
+                if not isdir(gasnet_root):
+                    raise InstallError(
+                        "gasnet_root: {0} -- no such directory.".format(
+                            gasnet_root))
+                append(self.define('GASNet_ROOT_DIR', gasnet_root))
             else:
-                options.append('-DLegion_EMBED_GASNet=ON')
-
-            gasnet_conduit = spec.variants['conduit'].value
-            options.append('-DGASNet_CONDUIT=%s' % gasnet_conduit)
-
-            if '+gasnet_debug' in spec:
-                options.append('-DLegion_EMBED_GASNet_CONFIGURE_ARGS=--enable-debug')
-        elif 'network=mpi' in spec:
-            options.append('-DLegion_NETWORKS=mpi')
-            if spec.variants['gasnet_root'].value != 'none':
-                raise InstallError("'gasnet_root' is only valid when 'network=gasnet'.")
-        else:
-            if spec.variants['gasnet_root'].value != 'none':
-                raise InstallError("'gasnet_root' is only valid when 'network=gasnet'.")
-            options.append('-DLegion_EMBED_GASNet=OFF')
-
-        if '+shared' in spec:
-            options.append('-DBUILD_SHARED_LIBS=ON')
-        else:
-            options.append('-DBUILD_SHARED_LIBS=OFF')
-
-        if '+bounds_checks' in spec:
-            # default is off.
-            options.append('-DLegion_BOUNDS_CHECKS=ON')
-        if '+privilege_checks' in spec:
-            # default is off.
-            options.append('-DLegion_PRIVILEGE_CHECKS=ON')
-        if '+enable_tls' in spec:
-            # default is off.
-            options.append('-DLegion_ENABLE_TLS=ON')
-        if 'output_level' in spec:
-            level = str.upper(spec.variants['output_level'].value)
-            options.append('-DLegion_OUTPUT_LEVEL=%s' % level)
-        if '+spy' in spec:
-            # default is off.
-            options.append('-DLegion_SPY=ON')
-
-        if '+cuda' in spec:
-            cuda_arch = spec.variants['cuda_arch'].value
-            options.append('-DLegion_USE_CUDA=ON')
-            options.append('-DLegion_GPU_REDUCTIONS=ON')
-            options.append('-DLegion_CUDA_ARCH=%s' % cuda_arch)
-            if '+cuda_hijack' in spec:
-                options.append('-DLegion_HIJACK_CUDART=ON')
-            else:
-                options.append('-DLegion_HIJACK_CUDART=OFF')
-
-            if '+cuda_unsupported_compiler' in spec:
-                options.append('-DCUDA_NVCC_FLAGS:STRING=--allow-unsupported-compiler')
+                append(self.define('Legion_EMBED_GASNet', True))
 
-        if '+hip' in spec:
-            options.append('-DLegion_USE_HIP=ON')
-            options.append('-DLegion_HIP_TARGET=ROCM')
+            gasnet_conduit = variants['conduit'].value
+            append(self.define('GASNet_CONDUIT', gasnet_conduit))
 
-        if '+fortran' in spec:
-            # default is off.
-            options.append('-DLegion_USE_Fortran=ON')
-
-        if '+hdf5' in spec:
-            # default is off.
-            options.append('-DLegion_USE_HDF5=ON')
-
-        if '+hwloc' in spec:
-            # default is off.
-            options.append('-DLegion_USE_HWLOC=ON')
-
-        if '+kokkos' in spec:
-            # default is off.
-            options.append('-DLegion_USE_Kokkos=ON')
-            os.environ['KOKKOS_CXX_COMPILER'] = spec['kokkos'].kokkos_cxx
-
-        if '+libdl' in spec:
-            # default is on.
-            options.append('-DLegion_USE_LIBDL=ON')
+            if variants['gasnet_debug'].value:
+                append(
+                    self.define('Legion_EMBED_GASNet_CONFIGURE_ARGS',
+                                '--enable-debug'))
+        elif network == 'mpi':
+            append(self.define('Legion_NETWORKS', 'mpi'))
         else:
-            options.append('-DLegion_USE_LIBDL=OFF')
-
-        if '+openmp' in spec:
-            # default is off.
-            options.append('-DLegion_USE_OpenMP=ON')
-
-        if '+papi' in spec:
-            # default is off.
-            options.append('-DLegion_USE_PAPI=ON')
-
-        if '+python' in spec:
-            # default is off.
-            options.append('-DLegion_USE_Python=ON')
-
-        if '+zlib' in spec:
-            # default is on.
-            options.append('-DLegion_USE_ZLIB=ON')
-        else:
-            options.append('-DLegion_USE_ZLIB=OFF')
-
-        if '+redop_complex' in spec:
-            # default is off.
-            options.append('-DLegion_REDOP_COMPLEX=ON')
-
-        if '+bindings' in spec:
+            append(self.define('Legion_EMBED_GASNet', False))
+
+        append(self.define_from_variant('BUILD_SHARED_LIBS', 'shared'))
+        options.extend(self.define_from_variant(cmake_opt, variant_name)
+                       for variant_name, cmake_opt in self._cmake_bool_variants)
+
+        # output_level always has a value, no need to test for its presence.
+        level = self._output_level_map[variants['output_level'].value]
+        append(self.define('Legion_OUTPUT_LEVEL', level))
+        if variants['cuda'].value:
+            cuda_arch = variants['cuda_arch'].value
+            append(self.define('Legion_USE_CUDA', True))
+            append(self.define('Legion_GPU_REDUCTIONS', True))
+            append(self.define('Legion_CUDA_ARCH', cuda_arch))
+            append(
+                self.define_from_variant('Legion_HIJACK_CUDART',
+                                         'cuda_hijack'))
+            if variants['cuda_unsupported_compiler'].value:
+                append(self.define('CUDA_NVCC_FLAGS',
+                                   '--allow-unsupported-compiler'))
+
+        if variants['hip'].value:
+            append(self.define('Legion_USE_HIP', True))
+            append(self.define('Legion_HIP_TARGET', 'ROCM'))
+
+        if variants['kokkos'].value:
             # default is off.
-            options.append('-DLegion_BUILD_BINDINGS=ON')
-            options.append('-DLegion_REDOP_COMPLEX=ON')  # required for bindings
-            options.append('-DLegion_USE_Fortran=ON')
-
-        if spec.variants['build_type'].value == 'Debug':
-            cmake_cxx_flags.extend([
-                '-DDEBUG_REALM',
-                '-DDEBUG_LEGION',
-                '-ggdb',
-            ])
-
-        maxdims = int(spec.variants['max_dims'].value)
+            append(self.define('Legion_USE_Kokkos', True))
+
+        # the bindings require fortran and the complex reduction operators
+        # no matter how those variants are set, so fold the three options
+        # together here and emit each exactly once.
+        bindings = variants['bindings'].value
+        append(self.define('Legion_BUILD_BINDINGS', bindings))
+        append(self.define('Legion_REDOP_COMPLEX',
+                           bindings or variants['redop_complex'].value))
+        append(self.define('Legion_USE_Fortran',
+                           bindings or variants['fortran'].value))
+
+        if variants['build_type'].value == 'Debug':
+            cmake_cxx_flags.extend(self._debug_cxx_flags)
+
+        if cmake_cxx_flags:
+            append(self.define('CMAKE_CXX_FLAGS',
+                               ' '.join(cmake_cxx_flags)))
+
+        maxdims = int(variants['max_dims'].value)
         # TODO: sanity check if maxdims < 0 || > 9???
-        options.append('-DLegion_MAX_DIM=%d' % maxdims)
+        append(self.define('Legion_MAX_DIM', maxdims))
 
-        maxfields = int(spec.variants['max_fields'].value)
+        maxfields = int(variants['max_fields'].value)
         if (maxfields <= 0):
             maxfields = 512
         # make sure maxfields is a power of two.  if not,
         # find the next largest power of two and use that...
         if (maxfields & (maxfields - 1) != 0):
-            while maxfields & maxfields - 1:
-                maxfields = maxfields & maxfields - 1
-            maxfields = maxfields << 1
-        options.append('-DLegion_MAX_FIELDS=%d' % maxfields)
+            maxfields = 1 << (maxfields - 1).bit_length()
+        append(self.define('Legion_MAX_FIELDS', maxfields))
 
-        if '+native' in spec:
+        if variants['native'].value:
             # default is off.
-            options.append('-DBUILD_MARCH:STRING=native')
+            append(self.define('BUILD_MARCH', 'native'))
 
+        self._cmake_args_cache = options
         return options